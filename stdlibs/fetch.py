@@ -1,14 +1,22 @@
 # Copyright 2021 John Reese
 # Licensed under the MIT license
 
+import ast
+import hashlib
+import itertools
+import json
+import mmap
+import os
 import re
+import shutil
 import subprocess
 import sys
+import tarfile
+import tempfile
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Optional, Set
-
-import libcst as cst
-import libcst.matchers as m
+from typing import Iterator, Optional, Set
 
 BASE_DIR = (Path.cwd() / Path(__file__)).parent
 
@@ -30,53 +38,55 @@ RELEASES = {
     "3.9": "https://www.python.org/ftp/python/3.9.5/Python-3.9.5.tgz",
     "3.10": "https://www.python.org/ftp/python/3.10.0/Python-3.10.0b1.tgz",
 }
-
-MODULE_DEF_RE = re.compile(r"PyModuleDef .*? = \{\s*[^,]*,\s*([^,}]+)[,}]")
+RELEASE_FILES = {v: url.rsplit("/", 1)[1] for v, url in RELEASES.items()}
+RELEASE_BASES = {v: f.rsplit(".", 1)[0] for v, f in RELEASE_FILES.items()}
+
+# PyModuleDef (3.x) or Py_InitModule (2.x), in one pass; any PyModuleDef in the
+# file wins over a Py_InitModule, even one that comes before it
+MODULE_TOKEN_RE = re.compile(
+    rb"PyModuleDef .*? = \{\s*[^,]*,\s*(?P<mod>[^,}]+)[,}]"
+    rb"|.Py_InitModule\d?\(\s*(?!\))(?P<mod2>.*?),"
+)
 MULTILINE_COMMENT_RE = re.compile(r"/\*.*?\*/")
-PY2_INITMODULE_RE = re.compile(r".Py_InitModule\d?\(\s*(?!\))(.*?),")
+INITTAB_START = "_PyImport_Inittab[] = {"
 INITTAB_RE = re.compile(r'{"([^"]+)", \S+?\}')
 
 # lib2to3 outputs code that doesn't parse, so just omit these lines
-PY2_LINES_TO_OMIT = [
-    "join(F, fw + '.framework', H)",
-    "for fw in 'Tcl', 'Tk'",
-    "for fw in ('Tcl', 'Tk')",
-    "for H in 'Headers', 'Versions/Current/PrivateHeaders'",
-]
-
-
-with open(__file__) as f:
-    MY_COPYRIGHT_HEADER = ""
-    while True:
-        _line = f.readline()
-        if not _line.strip():
-            break
-        MY_COPYRIGHT_HEADER += _line
-
-GENERATED_TMPL = (
-    MY_COPYRIGHT_HEADER
-    + """\
-
-# Generated by stdlibs/fetch.py
-
-module_names = frozenset(
-    [
-{lines}    ]
-)
-"""
+PY2_LINES_TO_OMIT = frozenset(
+    {
+        "join(F, fw + '.framework', H)",
+        "for fw in 'Tcl', 'Tk'",
+        "for fw in ('Tcl', 'Tk')",
+        "for H in 'Headers', 'Versions/Current/PrivateHeaders'",
+    }
 )
 
+MY_COPYRIGHT_HEADER = "# Copyright 2021 John Reese\n# Licensed under the MIT license\n"
+
 
 def write_tmpl(name: str, data: Set[str]) -> None:
-    lines = "".join(f'        "{s}",\n' for s in sorted(data))
-    (BASE_DIR / name).write_text(GENERATED_TMPL.format(lines=lines))
+    buf = bytearray(MY_COPYRIGHT_HEADER.encode())
+    buf += b"\n# Generated by stdlibs/fetch.py\n\nmodule_names = frozenset(\n    [\n"
+    for s in sorted(data):
+        buf += b'        "'
+        buf += s.encode()
+        buf += b'",\n'
+    buf += b"    ]\n)\n"
+    (BASE_DIR / name).write_bytes(buf)
 
 
 def regen_all() -> None:
     all2: Set[str] = set()
     all3: Set[str] = set()
-    for v in RELEASES:
-        names = regen(v)
+
+    # downloads are network bound, so get them all in flight at once
+    with ThreadPoolExecutor(len(RELEASES)) as tex:
+        list(tex.map(fetch_release, RELEASES))
+
+    with ProcessPoolExecutor() as ex:
+        results = list(ex.map(regen, RELEASES))
+
+    for v, names in zip(RELEASES, results):
         if v.startswith("2"):
             all2 |= names
         elif v.startswith("3"):
@@ -91,179 +101,262 @@ def regen_all() -> None:
     print("done")
 
 
-def regen(version: str) -> Set[str]:
-    base_path = Path(".cache", RELEASES[version].split("/")[-1].rsplit(".", 1)[0])
-    setup_path = base_path / "setup.py"
+def fetch_release(version: str) -> Path:
+    """
+    Download and extract a release if it isn't cached yet, returning its setup.py.
+    """
+    base_path = Path(".cache", RELEASE_BASES[version])
 
     if not base_path.exists():
         Path(".cache").mkdir(exist_ok=True)
-        subprocess.check_call(["wget", "-c", RELEASES[version]], cwd=".cache")
-        subprocess.check_call(
-            ["tar", "-xvzf", RELEASES[version].split("/")[-1]], cwd=".cache"
-        )
-        if version.startswith("2"):
-            (base_path / "fixed").mkdir(exist_ok=True)
-            subprocess.check_call(
-                [
-                    sys.executable,
-                    "-m",
-                    "lib2to3",
-                    "-n",
-                    "-w",
-                    "-o",
-                    str(base_path / "fixed"),
-                    str(base_path / "setup.py"),
+        # Work in a temp dir and only move it into place once everything has
+        # succeeded, so an interrupted download never looks like a cached copy.
+        tmp_dir = Path(tempfile.mkdtemp(dir=".cache"))
+        try:
+            with urllib.request.urlopen(RELEASES[version]) as r, tarfile.open(
+                fileobj=r, mode="r|gz"
+            ) as tar:
+                tar.extractall(tmp_dir, filter="data")
+
+            tmp_base = tmp_dir / base_path.name
+            if version.startswith("2"):
+                (tmp_base / "fixed").mkdir(exist_ok=True)
+                subprocess.check_call(
+                    [
+                        sys.executable,
+                        "-m",
+                        "lib2to3",
+                        "-n",
+                        "-w",
+                        "-o",
+                        str(tmp_base / "fixed"),
+                        str(tmp_base / "setup.py"),
+                    ]
+                )
+
+                fixed_path = tmp_base / "fixed" / "setup.py"
+                lines = fixed_path.read_text().splitlines(True)
+                lines = [
+                    line for line in lines if line.strip() not in PY2_LINES_TO_OMIT
                 ]
-            )
-
-            # TODO if the extraction succeeded but now this fails, we can end up
-            # with a corrupt copy.
-            setup_path = base_path / "fixed" / "setup.py"
-            lines = setup_path.read_text().splitlines(True)
-            lines = [line for line in lines if line.strip() not in PY2_LINES_TO_OMIT]
-            setup_path.write_text("".join(lines))
-    elif version.startswith("2"):
-        setup_path = base_path / "fixed" / "setup.py"
-
-    module = try_parse(setup_path)
+                fixed_path.write_text("".join(lines))
+
+            tmp_base.rename(base_path)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    if version.startswith("2"):
+        return base_path / "fixed" / "setup.py"
+    return base_path / "setup.py"
+
+
+def regen(version: str) -> Set[str]:
+    base_path = Path(".cache", RELEASE_BASES[version])
+    setup_path = fetch_release(version)
+
+    module_name = f"py{version.replace('.', '')}.py"
+    setup_data = setup_path.read_bytes()
+    cache_path = base_path / f".names-{cache_key(base_path, setup_data)}.json"
+    if cache_path.exists():
+        cached = set(json.loads(cache_path.read_text()))
+        write_tmpl(module_name, cached)
+        print(f"{version} done (cached).")
+        return cached
+
+    module = try_parse(setup_path, setup_data)
     ev = ExtensionVisitor()
-    module.visit(ev)
+    ev.visit(module)
+
+    names = set(
+        itertools.chain(
+            ev.extension_names,
+            lib_names(base_path),
+            c_module_names(base_path),
+            inittab_names(base_path),
+            aliases(version),
+        )
+    )
+
+    tmp_path = cache_path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(sorted(names)))
+    tmp_path.replace(cache_path)
+    for old_path in base_path.glob(".names-*.json"):
+        if old_path != cache_path:
+            old_path.unlink()
+
+    write_tmpl(module_name, names)
+    print(f"{version} done.")
+    return names
 
-    # Python files
-    names = ev.extension_names[:]
-    for p in (base_path / "Lib").glob("*"):
+
+def lib_names(base_path: Path) -> Iterator[str]:
+    """
+    Python files and packages in Lib/.
+    """
+    for p in os.scandir(base_path / "Lib"):
         if p.name.startswith(("plat-", "lib-")):
             # 2.x platform dirs, or tk support
-            for path in p.iterdir():
+            for path in os.scandir(p.path):
                 # lib-tk/test on 2.7
                 if path.name in ("test",):
                     continue
                 # TODO plat-mac/lib-scriptpackages
-                if path.is_dir() and not path.name.startswith("lib-"):
-                    names.append(path.name)
+                if path.is_dir(follow_symlinks=False) and not path.name.startswith(
+                    "lib-"
+                ):
+                    yield path.name
                 elif path.name.endswith(".py"):
-                    name = path.with_suffix("").name
-                    names.append(name)
+                    yield path.name[:-3]
         else:
-            name = p.with_suffix("").name
-            name = name.split(".")[0]  # __phello__.foo
+            name = p.name.partition(".")[0]  # __phello__.foo
             if name not in ("__pycache__", "site-packages", "test"):
-                names.append(name)
+                yield name
+
 
+def c_module_names(base_path: Path) -> Iterator[str]:
+    """
+    Extension modules defined in .c files, found via PyModuleDef/Py_InitModule.
+    """
     for subdir in (
         "Python",  # builtin
         "Modules",  # other extensions, some of which are built-in :/
         "PC",  # windows
     ):
-        for p in (base_path / subdir).glob("*.c"):
-            try:
-                data = p.read_text()
-            except UnicodeDecodeError:
-                data = p.read_text(encoding="latin-1")
-
-            match = MODULE_DEF_RE.search(data) or PY2_INITMODULE_RE.search(data)
-            if match:
-                s = MULTILINE_COMMENT_RE.sub("", match.group(1)).strip()
-                if s.startswith(".m_name"):
-                    s = s.split("=")[1].strip()
-
-                if s.startswith('"') and s.endswith('"'):
-                    names.append(s.strip('"'))
-                elif p.name in ("_warnings.c", "_sre.c", "pyexpat.c", "_bsddb.c"):
-                    names.append(p.with_suffix("").name)
-                elif p.name in ("socketmodule.c", "posixmodule.c"):
-                    names.append(p.name.split("module")[0])
-                else:
-                    print(f"Unknown module for {s} in {p}, skipped")
-
-    # Some names are listed differently/better here; cjkcodecs and _io/io
+        for p in os.scandir(base_path / subdir):
+            if not p.name.endswith(".c") or not p.stat().st_size:
+                continue
+            with open(p.path, "rb") as f, mmap.mmap(
+                f.fileno(), 0, access=mmap.ACCESS_READ
+            ) as mm:
+                # most files have neither, and find() is much cheaper than search()
+                if mm.find(b"PyModuleDef") == -1 and mm.find(b"Py_InitModule") == -1:
+                    continue
+                group: Optional[bytes] = None
+                for match in MODULE_TOKEN_RE.finditer(mm):
+                    if match.group("mod"):
+                        group = match.group("mod")
+                        break
+                    if group is None:
+                        group = match.group("mod2")
+                if group is None:
+                    continue
+
+            # latin-1 can decode anything, and we only need the ascii bits
+            s = MULTILINE_COMMENT_RE.sub("", group.decode("latin-1")).strip()
+            if s.startswith(".m_name"):
+                s = s.split("=")[1].strip()
+
+            if s.startswith('"') and s.endswith('"'):
+                yield s.strip('"')
+            elif p.name in ("_warnings.c", "_sre.c", "pyexpat.c", "_bsddb.c"):
+                yield os.path.splitext(p.name)[0]
+            elif p.name in ("socketmodule.c", "posixmodule.c"):
+                yield p.name.split("module")[0]
+            else:
+                print(f"Unknown module for {s} in {p.path}, skipped")
+
+
+def inittab_names(base_path: Path) -> Iterator[str]:
+    """
+    Builtin modules listed in the Windows inittab, which gives the real import
+    names for modules like the cjkcodecs and _io that the .c scan names wrongly.
+    """
     for path in (
         base_path / "PC" / "config.c",
         base_path / "PC" / "os2vacpp" / "config.c",
     ):
         if not path.exists():
             continue
-        for match in INITTAB_RE.finditer(
-            path.read_text().split("_PyImport_Inittab[] = {")[1]
-        ):
+        data = path.read_text()
+        for match in INITTAB_RE.finditer(data, data.index(INITTAB_START)):
             if match.group(1) == "__main__":
                 continue
-            names.append(match.group(1))
+            yield match.group(1)
 
-    # Aliases
+
+def aliases(version: str) -> Iterator[str]:
+    """
+    Frozen modules that don't appear anywhere else.
+    """
     version_tuple = tuple(int(x) for x in version.split("."))
     if version_tuple >= (3, 3):
-        names.append("_frozen_importlib")
+        yield "_frozen_importlib"
     if version_tuple >= (3, 5):
-        names.append("_frozen_importlib_external")
+        yield "_frozen_importlib_external"
 
-    write_tmpl(f"py{version.replace('.', '')}.py", set(names))
-    print(f"{version} done.")
-    return set(names)
+
+def cache_key(base_path: Path, setup_data: bytes) -> str:
+    """
+    Hash of everything that can change the names found by regen().
+
+    Covers the contents of setup.py, the mtimes of the directories scanned for
+    modules including the 2.x Lib/plat-* and Lib/lib-* dirs (cheap, catches
+    added/removed files), the mtimes of the inittab config.c files, and this
+    script itself.
+    """
+    h = hashlib.sha256(setup_data)
+    lib_subdirs = sorted(
+        Path(p.path)
+        for p in os.scandir(base_path / "Lib")
+        if p.name.startswith(("plat-", "lib-")) and p.is_dir()
+    )
+    for path in (
+        base_path / "Lib",
+        *lib_subdirs,
+        base_path / "Python",
+        base_path / "Modules",
+        base_path / "PC",
+        base_path / "PC" / "config.c",
+        base_path / "PC" / "os2vacpp" / "config.c",
+        Path(__file__),
+    ):
+        if path.exists():
+            h.update(f"{path}:{path.stat().st_mtime_ns};".encode())
+    return h.hexdigest()
 
 
-class ExtensionVisitor(cst.CSTVisitor):
+class ExtensionVisitor(ast.NodeVisitor):
     def __init__(self) -> None:
-        self.extension_names: List[str] = []
-
-    def visit_Call(self, node: cst.Call) -> None:
-        # print(node)
-        d = m.extract(
-            node,
-            m.Call(
-                func=m.OneOf(m.Name("Extension"), m.Name("addMacExtension")),
-                args=(
-                    m.Arg(value=m.SaveMatchedNode(m.SimpleString(), "extension_name")),
-                    m.ZeroOrMore(m.DoNotCare()),
-                ),
-            ),
-        )
-        if d:
-            assert isinstance(d["extension_name"], cst.SimpleString)
-            self.extension_names.append(d["extension_name"].evaluated_value)
-
-    def visit_Assign(self, node: cst.Assign) -> None:
-        d = m.extract(
-            node,
-            m.Assign(
-                targets=(m.AssignTarget(target=m.Name("CARBON_EXTS")),),
-                value=m.SaveMatchedNode(m.List(), "list"),
-            ),
-        )
-        if d:
-            assert isinstance(d["list"], cst.List)
-            for item in d["list"].elements:
-                if isinstance(item.value, cst.SimpleString):
-                    self.extension_names.append(item.value.evaluated_value)
+        self.extension_names: Set[str] = set()
 
+    def visit_Call(self, node: ast.Call) -> None:
+        if isinstance(node.func, ast.Name) and node.func.id in (
+            "Extension",
+            "addMacExtension",
+        ):
+            # name is either the first positional arg, or passed as name=
+            if node.args:
+                name: Optional[ast.expr] = node.args[0]
+            else:
+                name = next((k.value for k in node.keywords if k.arg == "name"), None)
+            if isinstance(name, ast.Constant) and isinstance(name.value, str):
+                self.extension_names.add(name.value)
+        self.generic_visit(node)
+
+    def visit_Assign(self, node: ast.Assign) -> None:
+        target = node.targets[0]
+        if (
+            isinstance(target, ast.Name)
+            and target.id == "CARBON_EXTS"
+            and isinstance(node.value, ast.List)
+        ):
+            for item in node.value.elts:
+                if isinstance(item, ast.Constant) and isinstance(item.value, str):
+                    self.extension_names.add(item.value)
+        self.generic_visit(node)
 
-# This is from usort
-def try_parse(path: Path, data: Optional[bytes] = None) -> cst.Module:
+
+def try_parse(path: Path, data: Optional[bytes] = None) -> ast.Module:
     """
-    Attempts to parse the file with all syntax versions known by LibCST.
+    Parses the file with the running interpreter's grammar.
 
-    If parsing fails on all supported grammar versions, then raises the parser error
-    from the first/newest version attempted.
+    Python 2 setup.py files have already been run through lib2to3, so every file
+    we care about parses as Python 3.
     """
     if data is None:
         data = path.read_bytes()
 
-    parse_error: Optional[cst.ParserSyntaxError] = None
-
-    for version in cst.KNOWN_PYTHON_VERSION_STRINGS[::-1]:
-        try:
-            mod = cst.parse_module(
-                data, cst.PartialParserConfig(python_version=version)
-            )
-            return mod
-        except cst.ParserSyntaxError as e:
-            # keep the first error we see in case parsing fails on all versions
-            if parse_error is None:
-                parse_error = e
-
-    # not caring about existing traceback here because it's not useful for parse
-    # errors, and usort_path is already going to wrap it in a custom class
-    raise parse_error or Exception("unknown parse failure")
+    return ast.parse(data, filename=str(path))
 
 
 if __name__ == "__main__":